@@ -1,12 +1,23 @@
 import asyncio
+import errno
+import hashlib
+import io
 import logging
+import multiprocessing
 import os
+import re
+import shutil
 import tempfile
+import time
 import zipfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
-from typing import Callable
+from typing import AsyncIterator, Callable, Iterator
 
 import fitz
+from fitz import mupdf
+from PIL import Image, ImageFile
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
@@ -21,97 +32,403 @@ logging.basicConfig(
     level=logging.INFO,
 )
 logger = logging.getLogger(__name__)
-OUTPUT_DPI = 500
+OUTPUT_DPI = 200
+MIN_DPI = 72
+MAX_DPI = 600
+DPI_PATTERN = re.compile(r"dpi=(\d+)", re.IGNORECASE)
+# "png-fast" (PNG, zlib level 1), "png" (PyMuPDF's default PNG encoder) or "jpeg"
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "png-fast")
+IMAGE_EXTENSIONS = {"png-fast": "png", "png": "png", "jpeg": "jpg"}
 MAX_ZIP_SIZE = 45 * 1024 * 1024  # 45MB (Telegram limit is 50MB, keep margin)
+DISK_USAGE_LIMIT = 0.8  # Share of free disk space conversions may use
+MAX_PENDING_UPLOADS = 1  # Finished ZIP parts allowed to wait for upload on disk
 PROGRESS_EVERY = 50  # Report progress every N pages
+DUPLICATES_NOTE = (
+    "Pages identical to an earlier page are saved as .txt files naming that page."
+)
+PROGRESS_MIN_INTERVAL = 3.0  # Seconds between progress messages
+MIN_PAGES_FOR_POOL = 8  # Render smaller PDFs in-process
+ENCODER_BLOCK_SIZE = 4 * 1024 * 1024  # Pillow encoder output block size
+PENDING_PAGES_PER_WORKER = 2  # Rendered pages allowed to wait for the ZIP writer
+PIXMAP_POOL_BYTES = 128 * 1024 * 1024  # Reusable page buffer memory per renderer
+SCAN_PAGE_COVERAGE = 0.98  # Share of the page a lone image must cover to be extracted
+# Embedded image formats (as reported by extract_image) stored without rendering
+EXTRACTED_IMAGE_EXTENSIONS = {"jpeg": "jpg", "png": "png"}
+
+# Fewer, larger encoder flushes (and PNG IDAT chunks) per page
+ImageFile.MAXBLOCK = ENCODER_BLOCK_SIZE
+
+_RGB = fitz.csRGB
+_DEFAULT_MATRIX = fitz.Matrix(OUTPUT_DPI / 72, OUTPUT_DPI / 72)
+
+
+def _page_matrix(dpi: int) -> fitz.Matrix:
+    """Zoom matrix for the given DPI, reusing the module-level one for the default."""
+    if dpi == OUTPUT_DPI:
+        return _DEFAULT_MATRIX
+    return fitz.Matrix(dpi / 72, dpi / 72)
+
+
+def _available_cpus() -> int:
+    """Number of CPUs this process may run on (respects cgroup/cpuset affinity)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+_worker_pdf: fitz.Document | None = None
+_worker_matrix: fitz.Matrix | None = None
+_worker_format = OUTPUT_FORMAT
+_worker_scratch: io.BytesIO | None = None
+_worker_pixmaps: dict[tuple[int, int], fitz.Pixmap] = {}
+
+
+def _init_worker(pdf_bytes: bytes, dpi: int, output_format: str) -> None:
+    """Open a per-process PDF handle (PyMuPDF documents can't cross processes)."""
+    global _worker_pdf, _worker_matrix, _worker_format, _worker_scratch
+    _worker_pdf = fitz.open(stream=pdf_bytes, filetype="pdf")
+    _worker_matrix = _page_matrix(dpi)
+    _worker_format = output_format
+    _worker_scratch = io.BytesIO()
+    _worker_pixmaps.clear()
+
+
+def _render_pixmap(
+    page: fitz.Page,
+    matrix: fitz.Matrix,
+    pixmap_pool: dict[tuple[int, int], fitz.Pixmap],
+) -> fitz.Pixmap:
+    """Render a page into a pooled RGB pixmap.
+
+    page.get_pixmap() allocates (and frees) a full-size samples buffer for every
+    page; here a buffer is only allocated the first time a page size is seen.
+    The pool keeps at most PIXMAP_POOL_BYTES of buffers, least recently used
+    sizes are dropped first. The returned pixmap is overwritten by the next page
+    of the same size.
+    """
+    irect = (page.rect * matrix).irect
+    key = (irect.width, irect.height)
+    pixmap = pixmap_pool.pop(key, None)
+    if pixmap is None:
+        pixmap = fitz.Pixmap(
+            "raw",
+            mupdf.fz_new_pixmap_with_bbox(
+                _RGB.this,
+                mupdf.FzIrect(*irect),
+                mupdf.FzSeparations(),
+                0,
+            ),
+        )
+    else:
+        # Same size, but the MediaBox/CropBox origin may differ
+        pixmap.set_origin(irect.x0, irect.y0)
+
+    # Most recently used size goes last
+    pixmap_pool[key] = pixmap
+    while sum(width * height * 3 for width, height in pixmap_pool) > PIXMAP_POOL_BYTES:
+        del pixmap_pool[next(iter(pixmap_pool))]
+
+    mupdf.fz_clear_pixmap_with_value(pixmap.this, 0xFF)
+    device = mupdf.fz_new_draw_device(mupdf.FzMatrix(*matrix), pixmap.this)
+    mupdf.fz_run_page(page.this, device, mupdf.FzMatrix(), mupdf.FzCookie())
+    mupdf.fz_close_device(device)
+    return pixmap
+
+
+def _encode_pixmap(
+    pixmap: fitz.Pixmap, output_format: str, scratch: io.BytesIO
+) -> bytes | memoryview:
+    """Encode an RGB pixmap as PNG or JPEG bytes.
+
+    The scratch buffer is reused between pages so it only grows to the largest
+    encoded page instead of being reallocated every time. Pillow output is
+    returned as a view into scratch, which must be released before the next page
+    is encoded.
+    """
+    if output_format == "png":
+        return pixmap.tobytes("png")
+
+    image = Image.frombuffer(
+        "RGB", (pixmap.width, pixmap.height), pixmap.samples_mv, "raw", "RGB", 0, 1
+    )
+    scratch.seek(0)
+    if output_format == "jpeg":
+        image.save(scratch, "JPEG", quality=85, subsampling=2)
+    else:
+        image.save(scratch, "PNG", compress_level=1, optimize=False)
+    # Drop whatever the previous (larger) page left behind
+    scratch.truncate()
+    return scratch.getbuffer()
+
+
+def _extract_scanned_image(page: fitz.Page) -> tuple[bytes, str] | None:
+    """Return the embedded image of a scanned page as-is, or None to render the page.
+
+    Only upright pages whose sole content is one opaque JPEG/PNG-compatible image
+    exactly covering the page, without Decode/Mask/ImageMask entries, qualify;
+    anything else would be lost or drawn differently otherwise.
+    """
+    if page.rotation or page.first_annot is not None:
+        return None
+    images = page.get_images(full=True)
+    if len(images) != 1:
+        return None
+    xref, smask = images[0][0], images[0][1]
+    if smask:
+        return None
+    placements = page.get_image_rects(xref, transform=True)
+    if len(placements) != 1:
+        return None
+    rect, transform = placements[0]
+    # Rotated or mirrored placements would be stored the wrong way round
+    if transform.b or transform.c or transform.a <= 0 or transform.d <= 0:
+        return None
+    # The image must fill the page and not extend past it (e.g. a cropped spread)
+    page_area = page.rect.get_area()
+    if (rect & page.rect).get_area() < page_area * SCAN_PAGE_COVERAGE:
+        return None
+    if page_area < rect.get_area() * SCAN_PAGE_COVERAGE:
+        return None
+    # Invisible text (type 3) is an OCR layer and doesn't show up when rendered
+    if page.get_cdrawings() or any(span["type"] != 3 for span in page.get_texttrace()):
+        return None
+
+    # These change how the raw image data is drawn, so the stream can't be used as-is
+    for key in ("Decode", "Mask", "ImageMask"):
+        if page.parent.xref_get_key(xref, key)[0] != "null":
+            return None
+
+    info = page.parent.extract_image(xref)
+    extension = EXTRACTED_IMAGE_EXTENSIONS.get(info["ext"])
+    if extension is None or info["colorspace"] not in (1, 3):
+        return None
+    return info["image"], extension
+
+
+def _render_page(
+    page: fitz.Page,
+    matrix: fitz.Matrix,
+    output_format: str,
+    scratch: io.BytesIO,
+    pixmap_pool: dict[tuple[int, int], fitz.Pixmap],
+) -> tuple[bytes | memoryview, str]:
+    """Render a single page to encoded image bytes. Returns (bytes, extension)."""
+    extracted = _extract_scanned_image(page)
+    if extracted is not None:
+        return extracted
+
+    pixmap = _render_pixmap(page, matrix, pixmap_pool)
+    image_bytes = _encode_pixmap(pixmap, output_format, scratch)
+    return image_bytes, IMAGE_EXTENSIONS[output_format]
+
+
+def _render_page_in_worker(page_index: int) -> tuple[bytes, str]:
+    assert _worker_pdf is not None and _worker_matrix is not None
+    assert _worker_scratch is not None
+    image_bytes, extension = _render_page(
+        _worker_pdf[page_index],
+        _worker_matrix,
+        _worker_format,
+        _worker_scratch,
+        _worker_pixmaps,
+    )
+    # The result is pickled back to the parent, so a scratch view must be copied
+    return bytes(image_bytes), extension
+
+
+def _iter_page_images(
+    pdf_bytes: bytes, total_pages: int, dpi: int, output_format: str
+) -> Iterator[tuple[bytes | memoryview, str]]:
+    """Yield (encoded image bytes, extension) for every page in page order."""
+    # Small documents aren't worth the process-spawn overhead
+    if total_pages < MIN_PAGES_FOR_POOL:
+        matrix = _page_matrix(dpi)
+        scratch = io.BytesIO()
+        pixmap_pool: dict[tuple[int, int], fitz.Pixmap] = {}
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+            for page in pdf:
+                image_bytes, extension = _render_page(
+                    page, matrix, output_format, scratch, pixmap_pool
+                )
+                # In-process pages are written straight from the scratch buffer
+                yield image_bytes, extension
+                if isinstance(image_bytes, memoryview):
+                    image_bytes.release()
+        return
+
+    workers = min(_available_cpus(), total_pages)
+    max_pending = workers * PENDING_PAGES_PER_WORKER
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(pdf_bytes, dpi, output_format),
+    )
+    pending: deque[Future[tuple[bytes, str]]] = deque()
+    next_index = 0
+    try:
+        while pending or next_index < total_pages:
+            # Bounded window: workers keep rendering while the caller writes the
+            # ZIP, but results can't pile up in memory if the writer falls behind
+            while next_index < total_pages and len(pending) < max_pending:
+                pending.append(executor.submit(_render_page_in_worker, next_index))
+                next_index += 1
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def _check_disk_space(path: Path, needed: int) -> None:
+    """Raise ENOSPC up front if needed bytes won't fit in the usable disk space."""
+    usable = int(shutil.disk_usage(path).free * DISK_USAGE_LIMIT)
+    if needed > usable:
+        raise OSError(
+            errno.ENOSPC,
+            f"Need about {needed} bytes of disk space, only {usable} available",
+        )
 
 
-def render_pages_to_files(
-    pdf_path: Path,
-    output_dir: Path,
+def render_and_pack(
+    pdf_bytes: bytes,
+    zip_dir: Path,
+    base_name: str,
     dpi: int = OUTPUT_DPI,
+    max_size: int = MAX_ZIP_SIZE,
     progress_callback: Callable[[int, int], None] | None = None,
-) -> list[Path]:
-    """Render each PDF page to a separate PNG file. Returns list of PNG paths."""
-    zoom = dpi / 72
-    matrix = fitz.Matrix(zoom, zoom)
-    png_files: list[Path] = []
-
-    with fitz.open(pdf_path) as pdf:
-        total_pages = len(pdf)
-        for page_number, page in enumerate(pdf, start=1):
-            image_path = output_dir / f"page_{page_number:04d}.png"
-            pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-            pixmap.save(str(image_path))
-            del pixmap
-            png_files.append(image_path)
-
-            if progress_callback and (
-                page_number % PROGRESS_EVERY == 0 or page_number == total_pages
-            ):
-                progress_callback(page_number, total_pages)
-
-    if not png_files:
+    output_format: str = OUTPUT_FORMAT,
+) -> Iterator[Path]:
+    """Render PDF pages straight into ZIP archives of at most max_size.
+
+    Scanned pages (a single full-page image) keep their embedded image at its
+    native resolution instead of being rendered at dpi.
+    Pages identical to an earlier page are stored once; the repeat is written as
+    a small "page_NNNN.<ext>.txt" entry naming the first occurrence.
+    Yields the path of each archive as soon as it is complete.
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        total_pages = pdf.page_count
+
+    if total_pages == 0:
         raise ValueError("The PDF file has no pages")
 
-    return png_files
-
-
-def pack_into_zips(
-    png_files: list[Path],
-    output_dir: Path,
-    base_name: str,
-    max_size: int = MAX_ZIP_SIZE,
-) -> list[Path]:
-    """Pack PNG files into one or more ZIP archives respecting max_size."""
-    zip_paths: list[Path] = []
+    extension = IMAGE_EXTENSIONS[output_format]
+    # Build all entry names up front instead of formatting one per page in the loop
+    arcnames = [f"page_{n:04d}.{extension}" for n in range(1, total_pages + 1)]
+    part = 0
     current_zip_path: Path | None = None
     current_zip: zipfile.ZipFile | None = None
-    current_size = 0
+    current_size = 0  # Bytes written to the current archive, headers included
+    # Content hash -> (part number, entry name) of the first copy of each page
+    seen: dict[bytes, tuple[int, str]] = {}
 
     def start_new_zip() -> None:
-        nonlocal current_zip_path, current_zip, current_size
-        part = len(zip_paths) + 1
-        if current_zip:
-            current_zip.close()
-        current_zip_path = output_dir / f"{base_name}_part{part}.zip"
+        nonlocal part, current_zip_path, current_zip, current_size
+        part += 1
+        current_zip_path = zip_dir / f"{base_name}_part{part}.zip"
+        # PNG/JPEG data is already compressed, recompressing it only burns CPU
         current_zip = zipfile.ZipFile(
-            current_zip_path, mode="w", compression=zipfile.ZIP_DEFLATED
+            current_zip_path, mode="w", compression=zipfile.ZIP_STORED
         )
         current_size = 0
-        zip_paths.append(current_zip_path)
 
     start_new_zip()
 
-    for png_path in png_files:
-        file_size = png_path.stat().st_size
-
-        # If adding this file would exceed limit and zip already has files, start new zip
-        if current_size + file_size > max_size and current_size > 0:
-            start_new_zip()
+    try:
+        for page_number, (image_bytes, image_extension) in enumerate(
+            _iter_page_images(pdf_bytes, total_pages, dpi, output_format), start=1
+        ):
+            arcname = arcnames[page_number - 1]
+            if image_extension != extension:
+                # Scanned page stored in its original format
+                arcname = f"page_{page_number:04d}.{image_extension}"
+            digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+            original = seen.get(digest)
+            entry_size = len(image_bytes) if original is None else 0
+
+            if page_number == 1:
+                # The caller keeps at most MAX_PENDING_UPLOADS finished parts on
+                # disk next to the archive being written
+                parts_on_disk = MAX_PENDING_UPLOADS + 1
+                needed = min(len(image_bytes) * total_pages, max_size * parts_on_disk)
+                _check_disk_space(zip_dir, needed + len(image_bytes))
+
+            # If adding this page would exceed limit and zip already has files, start new zip
+            if current_size + entry_size > max_size and current_size > 0:
+                assert current_zip is not None and current_zip_path is not None
+                current_zip.close()
+                yield current_zip_path
+                start_new_zip()
+
+            assert current_zip is not None
+            if original is None:
+                seen[digest] = (part, arcname)
+                current_zip.writestr(arcname, image_bytes)
+            else:
+                original_part, original_name = original
+                if original_part != part:
+                    original_zip = f"{base_name}_part{original_part}.zip"
+                    original_name = f"{original_zip}/{original_name}"
+                current_zip.writestr(
+                    f"{arcname}.txt",
+                    f"duplicate_of:{original_name}",
+                    compress_type=zipfile.ZIP_DEFLATED,
+                )
+            del image_bytes
+            assert current_zip.fp is not None
+            current_size = current_zip.fp.tell()
 
+            if progress_callback and (
+                page_number % PROGRESS_EVERY == 0 or page_number == total_pages
+            ):
+                progress_callback(page_number, total_pages)
+    finally:
         assert current_zip is not None
-        current_zip.write(png_path, arcname=png_path.name)
-        current_size += file_size
-
-    if current_zip:
         current_zip.close()
 
+    assert current_zip_path is not None
     # If only one part, rename to remove _part1 suffix
-    if len(zip_paths) == 1:
-        single_path = zip_paths[0]
-        final_path = output_dir / f"{base_name}.zip"
-        single_path.rename(final_path)
-        zip_paths = [final_path]
+    if part == 1:
+        final_path = zip_dir / f"{base_name}.zip"
+        current_zip_path.rename(final_path)
+        current_zip_path = final_path
+
+    yield current_zip_path
+
+
+async def iter_zip_parts(
+    pdf_bytes: bytes,
+    zip_dir: Path,
+    base_name: str,
+    dpi: int = OUTPUT_DPI,
+    max_size: int = MAX_ZIP_SIZE,
+    progress_callback: Callable[[int, int], None] | None = None,
+    output_format: str = OUTPUT_FORMAT,
+) -> AsyncIterator[Path]:
+    """Run render_and_pack in a worker thread, yielding each archive as it completes."""
+    parts = render_and_pack(
+        pdf_bytes, zip_dir, base_name, dpi, max_size, progress_callback, output_format
+    )
+    try:
+        while (zip_path := await asyncio.to_thread(next, parts, None)) is not None:
+            yield zip_path
+    finally:
+        await asyncio.to_thread(parts.close)
+
 
-    return zip_paths
+def parse_dpi(caption: str | None) -> int:
+    """Read a "dpi=N" option from the message caption, clamped to [MIN_DPI, MAX_DPI]."""
+    match = DPI_PATTERN.search(caption or "")
+    if not match:
+        return OUTPUT_DPI
+    return max(MIN_DPI, min(MAX_DPI, int(match.group(1))))
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message:
         return
     await update.message.reply_text(
-        "Send me a PDF file and I will return a ZIP archive with PNG images for each page."
+        "Send me a PDF file and I will return a ZIP archive with an image for each "
+        "page. Add a caption like dpi=300 to change the resolution "
+        f"({MIN_DPI}-{MAX_DPI}, default {OUTPUT_DPI})."
     )
 
 
@@ -130,99 +447,120 @@ async def handle_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     original_name = document.file_name or "document.pdf"
     pdf_name = Path(original_name).name
     base_name = Path(pdf_name).stem + "_images"
+    image_type = IMAGE_EXTENSIONS[OUTPUT_FORMAT].upper()
+    dpi = parse_dpi(update.message.caption)
 
-    await update.message.reply_text("PDF received. Converting pages to PNG images...")
+    await update.message.reply_text(
+        f"PDF received. Converting pages to {image_type} images at {dpi} DPI..."
+    )
 
     with tempfile.TemporaryDirectory() as temp_dir:
-        temp_dir_path = Path(temp_dir)
-        pdf_path = temp_dir_path / pdf_name
-        png_dir = temp_dir_path / "pages"
-        png_dir.mkdir()
-        zip_dir = temp_dir_path / "zips"
-        zip_dir.mkdir()
+        zip_dir = Path(temp_dir)
 
+        # Keep the PDF in memory; PyMuPDF and the render workers open it from bytes
         telegram_file = await document.get_file()
-        await telegram_file.download_to_drive(custom_path=str(pdf_path))
-
-        # Track progress messages to avoid spamming
-        last_reported = [0]
-
-        def on_progress(current: int, total: int) -> None:
-            last_reported[0] = current
-
-        try:
-            loop = asyncio.get_event_loop()
-
-            # Send progress updates while conversion runs
-            async def run_with_progress() -> list[Path]:
-                progress_state = {"current": 0, "total": 0}
-
-                def progress_cb(current: int, total: int) -> None:
-                    progress_state["current"] = current
-                    progress_state["total"] = total
-
-                conversion_task = asyncio.ensure_future(
-                    asyncio.to_thread(
-                        render_pages_to_files, pdf_path, png_dir, OUTPUT_DPI, progress_cb
-                    )
+        pdf_bytes = await telegram_file.download_as_bytearray()
+
+        loop = asyncio.get_running_loop()
+        progress_state = {"total": 0}
+        progress_queue: asyncio.Queue[tuple[int, int]] = asyncio.Queue()
+
+        def progress_cb(current: int, total: int) -> None:
+            # Runs in the conversion thread
+            progress_state["total"] = total
+            loop.call_soon_threadsafe(progress_queue.put_nowait, (current, total))
+
+        # Send progress updates while conversion runs
+        async def report_progress() -> None:
+            last_sent = time.monotonic()
+            while True:
+                current, total = await progress_queue.get()
+                if current >= total:
+                    return
+                if time.monotonic() - last_sent < PROGRESS_MIN_INTERVAL:
+                    continue
+                assert update.message is not None
+                await update.message.reply_text(
+                    f"Converting... {current}/{total} pages done."
                 )
+                last_sent = time.monotonic()
 
-                last_sent = 0
-                while not conversion_task.done():
-                    await asyncio.sleep(3)
-                    current = progress_state["current"]
-                    total = progress_state["total"]
-                    if total > 0 and current > last_sent and current < total:
-                        if current - last_sent >= PROGRESS_EVERY or current == total:
-                            assert update.message is not None
-                            await update.message.reply_text(
-                                f"Converting... {current}/{total} pages done."
-                            )
-                            last_sent = current
-
-                return await conversion_task
-
-            png_files = await run_with_progress()
-        except Exception:
-            logger.exception("Failed to convert PDF: %s", pdf_name)
-            await update.message.reply_text(
-                "I couldn't process this PDF. Please try another file."
-            )
-            return
-
-        page_count = len(png_files)
-
-        try:
-            zip_paths = await asyncio.to_thread(
-                pack_into_zips, png_files, zip_dir, base_name
-            )
-        except Exception:
-            logger.exception("Failed to pack ZIP archives: %s", pdf_name)
-            await update.message.reply_text(
-                "I couldn't create the archive. Please try another file."
-            )
-            return
-
-        total_parts = len(zip_paths)
-
-        for i, zip_path in enumerate(zip_paths, start=1):
-            if total_parts == 1:
+        async def send_part(zip_path: Path, part: int) -> None:
+            if zip_path.name == f"{base_name}.zip":
                 caption = (
-                    f"Done. Converted {page_count} page(s) to PNG "
-                    f"({OUTPUT_DPI} DPI) and packed them into this ZIP."
+                    f"Done. Converted {progress_state['total']} page(s) to "
+                    f"{image_type} ({dpi} DPI) and packed them into this ZIP. "
+                    f"{DUPLICATES_NOTE}"
                 )
             else:
-                caption = (
-                    f"Part {i} of {total_parts}. "
-                    f"Total: {page_count} page(s) at {OUTPUT_DPI} DPI."
-                )
+                caption = f"Part {part} ({dpi} DPI)."
+
+            try:
+                # A local Bot API server reads the archive straight from disk;
+                # otherwise load it off the event loop (PTB would read it synchronously)
+                if context.bot.local_mode:
+                    archive: Path | bytes = zip_path
+                else:
+                    archive = await asyncio.to_thread(zip_path.read_bytes)
 
-            with zip_path.open("rb") as archive_file:
+                assert update.message is not None
                 await update.message.reply_document(
-                    document=archive_file,
+                    document=archive,
                     filename=zip_path.name,
                     caption=caption,
                 )
+            finally:
+                # Free the disk space right away, later parts may still be rendering
+                zip_path.unlink(missing_ok=True)
+
+        progress_task = asyncio.create_task(report_progress())
+        # Each part is uploaded as soon as it is packed, while later parts render
+        uploads: list[asyncio.Task[None]] = []
+        converted = False
+        try:
+            async for zip_path in iter_zip_parts(
+                pdf_bytes, zip_dir, base_name, dpi, progress_callback=progress_cb
+            ):
+                part = len(uploads) + 1
+                uploads.append(asyncio.create_task(send_part(zip_path, part)))
+                # Don't render further ahead than MAX_PENDING_UPLOADS parts, so sent
+                # parts are removed before more pile up on disk
+                pending = [upload for upload in uploads if not upload.done()]
+                while len(pending) > MAX_PENDING_UPLOADS:
+                    await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    pending = [upload for upload in pending if not upload.done()]
+            converted = True
+        except Exception as exc:
+            if isinstance(exc, OSError) and exc.errno == errno.ENOSPC:
+                logger.warning("Not enough disk space to convert PDF: %s", pdf_name)
+                await update.message.reply_text(
+                    "This PDF is too large to convert right now. Please try a lower "
+                    "dpi=... or split the PDF into smaller files."
+                )
+            else:
+                logger.exception("Failed to convert PDF: %s", pdf_name)
+                await update.message.reply_text(
+                    "I couldn't process this PDF. Please try another file."
+                )
+        finally:
+            progress_task.cancel()
+            # Archives live in temp_dir, so let started uploads finish first
+            results = await asyncio.gather(*uploads, return_exceptions=True)
+
+        failed = [result for result in results if isinstance(result, BaseException)]
+        for error in failed:
+            logger.error("Failed to send ZIP part: %s", pdf_name, exc_info=error)
+        if failed:
+            await update.message.reply_text(
+                f"{len(failed)} of {len(uploads)} ZIP part(s) could not be sent. "
+                "Please try again."
+            )
+        elif converted and len(uploads) > 1:
+            await update.message.reply_text(
+                f"Done. Converted {progress_state['total']} page(s) to {image_type} "
+                f"({dpi} DPI) and split them into {len(uploads)} ZIP parts. "
+                f"{DUPLICATES_NOTE}"
+            )
 
 
 async def handle_non_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -235,8 +573,26 @@ def main() -> None:
     token = os.environ.get("TELEGRAM_BOT_TOKEN")
     if not token:
         raise ValueError("TELEGRAM_BOT_TOKEN environment variable is not set")
+    if OUTPUT_FORMAT not in IMAGE_EXTENSIONS:
+        raise ValueError(f"OUTPUT_FORMAT must be one of: {', '.join(IMAGE_EXTENSIONS)}")
+
+    # Pool workers fork from a server that has already imported PyMuPDF, instead of
+    # paying the interpreter start-up and import cost for every conversion
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method("forkserver")
+        multiprocessing.set_forkserver_preload(["__main__", "fitz"])
+
+    builder = ApplicationBuilder().token(token)
+    api_url = os.environ.get("TELEGRAM_API_URL")
+    if api_url:
+        # Self-hosted Bot API server: files are exchanged by path instead of HTTP
+        builder = (
+            builder.base_url(f"{api_url}/bot")
+            .base_file_url(f"{api_url}/file/bot")
+            .local_mode(True)
+        )
 
-    app = ApplicationBuilder().token(token).build()
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_pdf))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_non_pdf))